@@ -3,11 +3,13 @@ A custom manager for working with trees of objects.
 """
 import contextlib
 import functools
+import operator
+import os
 import uuid
 from collections import defaultdict
-from itertools import groupby
+from itertools import chain, groupby
 
-from django.db import connections, models, router
+from django.db import connections, models, router, transaction
 from django.db.models import (
     F,
     IntegerField,
@@ -17,6 +19,7 @@ from django.db.models import (
     Q,
     Subquery,
 )
+from django.db.models.query_utils import DeferredAttribute
 from django.utils.translation import gettext as _
 
 from mptt.compat import cached_field_value
@@ -25,6 +28,12 @@ from mptt.querysets import TreeQuerySet
 from mptt.signals import node_moved
 from mptt.utils import _get_tree_model, clean_tree_ids
 
+
+try:
+    from fast_update.query import FastUpdateQuerySet
+except ImportError:
+    FastUpdateQuerySet = None
+
 __all__ = ("TreeManager",)
 
 
@@ -33,6 +42,213 @@ class SQCount(Subquery):
     output_field = IntegerField()
 
 
+# Raw SQL used to rearrange trees. The placeholders in braces are filled in
+# with quoted table and column names by TreeManager._get_sql_templates().
+_SQL_TEMPLATES = {
+    "space": """
+            UPDATE {table}
+            SET {left} = CASE
+                    WHEN {left} > %s
+                        THEN {left} + %s
+                    ELSE {left} END,
+                {right} = CASE
+                    WHEN {right} > %s
+                        THEN {right} + %s
+                    ELSE {right} END
+            WHERE {tree_id} = %s
+              AND {right} > %s""",
+    "inter_tree_move": """
+        UPDATE {table}
+        SET {level} = CASE
+                WHEN {left} >= %s AND {left} <= %s
+                    THEN {level} - %s
+                ELSE {level} END,
+            {tree_id} = CASE
+                WHEN {left} >= %s AND {left} <= %s
+                    THEN %s
+                ELSE {tree_id} END,
+            {left} = CASE
+                WHEN {left} >= %s AND {left} <= %s
+                    THEN {left} - %s
+                WHEN {left} > %s
+                    THEN {left} - %s
+                ELSE {left} END,
+            {right} = CASE
+                WHEN {right} >= %s AND {right} <= %s
+                    THEN {right} - %s
+                WHEN {right} > %s
+                    THEN {right} - %s
+                ELSE {right} END
+        WHERE {tree_id} = %s""",
+    # Creates the space in the destination tree, moves the subtree into it
+    # and closes the gap left in the source tree. Every expression refers to
+    # the original values, so this can't be used with MySQL, which assigns
+    # the columns one after another. Carrying the original values through
+    # user variables (SET @x := ...) would work around that, but assigning
+    # them within expressions is deprecated since MySQL 8.0.13, so MySQL
+    # makes the space and moves the subtree with separate queries instead.
+    "move_to_other_tree": """
+        UPDATE {table}
+        SET {level} = CASE
+                WHEN {tree_id} = %s AND {left} >= %s AND {left} <= %s
+                    THEN {level} - %s
+                ELSE {level} END,
+            {left} = CASE
+                WHEN {tree_id} = %s AND {left} > %s
+                    THEN {left} + %s
+                WHEN {tree_id} = %s AND {left} >= %s AND {left} <= %s
+                    THEN {left} - %s
+                WHEN {tree_id} = %s AND {left} > %s
+                    THEN {left} - %s
+                ELSE {left} END,
+            {right} = CASE
+                WHEN {tree_id} = %s AND {right} > %s
+                    THEN {right} + %s
+                WHEN {tree_id} = %s AND {right} >= %s AND {right} <= %s
+                    THEN {right} - %s
+                WHEN {tree_id} = %s AND {right} > %s
+                    THEN {right} - %s
+                ELSE {right} END,
+            {tree_id} = CASE
+                WHEN {tree_id} = %s AND {left} >= %s AND {left} <= %s
+                    THEN %s
+                ELSE {tree_id} END
+        WHERE {tree_id} IN (%s, %s)""",
+    # Makes a subtree the root of a new tree, after the tree ids following
+    # it have been shifted up to make room, and closes the gap left in its
+    # source tree. Every expression refers to the original values, so this
+    # can't be used with MySQL.
+    "child_to_root_sibling": """
+        UPDATE {table}
+        SET {level} = CASE
+                WHEN {tree_id} = %s AND {left} >= %s AND {left} <= %s
+                    THEN {level} - %s
+                ELSE {level} END,
+            {left} = CASE
+                WHEN {tree_id} = %s AND {left} >= %s AND {left} <= %s
+                    THEN {left} - %s
+                WHEN {tree_id} = %s AND {left} > %s
+                    THEN {left} - %s
+                ELSE {left} END,
+            {right} = CASE
+                WHEN {tree_id} = %s AND {right} >= %s AND {right} <= %s
+                    THEN {right} - %s
+                WHEN {tree_id} = %s AND {right} > %s
+                    THEN {right} - %s
+                ELSE {right} END,
+            {tree_id} = CASE
+                WHEN {tree_id} = %s AND {left} >= %s AND {left} <= %s
+                    THEN %s
+                WHEN {tree_id} > %s
+                    THEN {tree_id} + 1
+                ELSE {tree_id} END
+        WHERE {tree_id} = %s OR {tree_id} > %s""",
+    "root_sibling": """
+            UPDATE {table}
+            SET {tree_id} = CASE
+                WHEN {tree_id} = %s
+                    THEN %s
+                ELSE {tree_id} + %s END
+            WHERE {tree_id} >= %s AND {tree_id} <= %s""",
+    # The level update must come before the left update to keep
+    # MySQL happy - left seems to refer to the updated value
+    # immediately after its update has been specified in the query
+    # with MySQL, but not with SQLite or Postgres.
+    "move_subtree": """
+        UPDATE {table}
+        SET {level} = CASE
+                WHEN {left} >= %s AND {left} <= %s
+                  THEN {level} - %s
+                ELSE {level} END,
+            {left} = CASE
+                WHEN {left} >= %s AND {left} <= %s
+                  THEN {left} + %s
+                WHEN {left} >= %s AND {left} <= %s
+                  THEN {left} + %s
+                ELSE {left} END,
+            {right} = CASE
+                WHEN {right} >= %s AND {right} <= %s
+                  THEN {right} + %s
+                WHEN {right} >= %s AND {right} <= %s
+                  THEN {right} + %s
+                ELSE {right} END
+        WHERE {tree_id} = %s
+          AND ({left} BETWEEN %s AND %s OR {right} BETWEEN %s AND %s)""",
+}
+
+
+@functools.lru_cache(maxsize=512)
+def _translate_lookup(mptt_meta, lookup):
+    """
+    Translates the name-agnostic MPTT field names in ``lookup`` (for example
+    ``parent__isnull`` or ``tree_id__gt``) to the field names configured in
+    ``mptt_meta``.
+
+    The result only depends on the model's options, so it is cached per
+    options instance rather than per manager, as managers are copied between
+    models.
+    """
+    return "__".join(
+        getattr(mptt_meta, part + "_attr", part) for part in lookup.split("__")
+    )
+
+
+def _new_span_within_tree(left, right, target_left, target_right, position):
+    """
+    Returns the ``(left, right)`` values that the node spanning ``left`` to
+    ``right`` ends up with when it is moved relative to the node spanning
+    ``target_left`` to ``target_right`` in the same tree, as specified by
+    ``position``. This is plain integer arithmetic on the values, so moves
+    don't need to look anything up on the nodes to work it out.
+    """
+    # the value after which the node is moved, as numbered before the move.
+    if position == "last-child":
+        after = target_right - 1
+    elif position == "first-child":
+        after = target_left
+    elif position == "left":
+        after = target_left - 1
+    else:
+        after = target_right
+
+    width = right - left + 1
+    if after >= right:
+        # the values between the node and ``after`` move left to close the
+        # gap it leaves.
+        return after - width + 1, after
+    return after + 1, after + width
+
+
+def _sibling_ranges(rows, min_index, max_index):
+    """
+    Merges the ``(tree_id, parent, left, right)`` rows of contiguous siblings,
+    ordered by those columns, into ``(min, max)`` ranges of the values at
+    ``min_index`` and ``max_index``, keyed by tree id.
+    """
+    ranges = defaultdict(list)
+    for _key, group in groupby(rows, key=operator.itemgetter(0, 1)):
+        next_lft = None
+        for row in group:
+            tree, lft, rght = row[0], row[2], row[3]
+            min_val = row[min_index]
+            max_val = row[max_index]
+            if next_lft is None:
+                next_lft = rght + 1
+                min_max = {"min": min_val, "max": max_val}
+            elif lft == next_lft:
+                if min_val < min_max["min"]:
+                    min_max["min"] = min_val
+                if max_val > min_max["max"]:
+                    min_max["max"] = max_val
+                next_lft = rght + 1
+            elif lft != next_lft:
+                ranges[tree].append((min_max["min"], min_max["max"]))
+                min_max = {"min": min_val, "max": max_val}
+                next_lft = rght + 1
+        ranges[tree].append((min_max["min"], min_max["max"]))
+    return ranges
+
+
 def delegate_manager(method):
     """
     Delegate method calls to base manager, if exists.
@@ -53,11 +269,25 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
     A manager for working with trees of objects.
     """
 
+    # Querysets of up to this many nodes are read in one go by
+    # ``_get_queryset_relatives()``, larger ones are streamed.
+    _range_fastpath_threshold = 500
+
     def contribute_to_class(self, model, name):
         super().contribute_to_class(model, name)
+        # SQL templates built for this model, keyed by database alias.
+        self._sql_templates = {}
 
         if not model._meta.abstract:
             self.tree_model = _get_tree_model(model)
+            self._find_out_rebuild_fields()
+            # returns the (left, right, level, tree_id) values of a node.
+            self._node_state = operator.attrgetter(
+                self.left_attr, self.right_attr, self.level_attr, self.tree_id_attr
+            )
+            # whether _set_node_state() can write to the instance __dict__,
+            # found out on first use, once the tree fields have been added.
+            self._node_state_in_dict = None
 
             self._base_manager = None
             if self.tree_model and self.tree_model is not model:
@@ -74,6 +304,17 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
             .order_by(self.tree_id_attr, self.left_attr)
         )
 
+    @delegate_manager
+    def _unordered_queryset(self):
+        """
+        Returns this manager's queryset without the tree ordering, for
+        internal queries where the order of the rows does not matter.
+        """
+        if type(self).get_queryset is TreeManager.get_queryset:
+            # skip ordering the queryset only to clear the ordering again.
+            return super().get_queryset()
+        return self.get_queryset().order_by()
+
     def _get_queryset_relatives(self, queryset, direction, include_self):
         """
         Returns a queryset containing either the descendants
@@ -115,8 +356,6 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
 
         opts = queryset.model._mptt_meta
 
-        filters = Q()
-
         e = "e" if include_self else ""
         max_op = "lt" + e
         min_op = "gt" + e
@@ -131,64 +370,40 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         min_key = f"{min_attr}__{min_op}"
         max_key = f"{max_attr}__{max_op}"
 
-        q = queryset.order_by(opts.tree_id_attr, opts.parent_attr, opts.left_attr).only(
-            opts.tree_id_attr,
-            opts.left_attr,
-            opts.right_attr,
-            min_attr,
-            max_attr,
-            opts.parent_attr,
-            # These fields are used by MPTTModel.update_mptt_cached_fields()
-            *[f.lstrip("-") for f in opts.order_insertion_by],
-        )
+        # Only these values are needed, so don't instantiate any models.
+        fields = (opts.tree_id_attr, opts.parent_attr, opts.left_attr, opts.right_attr)
+        min_index = fields.index(min_attr)
+        max_index = fields.index(max_attr)
 
-        if not q:
-            return self.none()
+        q = queryset.order_by(
+            opts.tree_id_attr, opts.parent_attr, opts.left_attr
+        ).values_list(*fields)
 
-        for group in groupby(
-            q,
-            key=lambda n: (
-                getattr(n, opts.tree_id_attr),
-                getattr(n, opts.parent_attr + "_id"),
-            ),
-        ):
-            next_lft = None
-            for node in list(group[1]):
-                tree, lft, rght, min_val, max_val = (
-                    getattr(node, opts.tree_id_attr),
-                    getattr(node, opts.left_attr),
-                    getattr(node, opts.right_attr),
-                    getattr(node, min_attr),
-                    getattr(node, max_attr),
-                )
-                if next_lft is None:
-                    next_lft = rght + 1
-                    min_max = {"min": min_val, "max": max_val}
-                elif lft == next_lft:
-                    if min_val < min_max["min"]:
-                        min_max["min"] = min_val
-                    if max_val > min_max["max"]:
-                        min_max["max"] = max_val
-                    next_lft = rght + 1
-                elif lft != next_lft:
-                    filters |= Q(
-                        **{
-                            tree_key: tree,
-                            min_key: min_max["min"],
-                            max_key: min_max["max"],
-                        }
-                    )
-                    min_max = {"min": min_val, "max": max_val}
-                    next_lft = rght + 1
-            filters |= Q(
-                **{
-                    tree_key: tree,
-                    min_key: min_max["min"],
-                    max_key: min_max["max"],
-                }
+        # Small querysets are read in one go. The rows of larger ones after
+        # those are streamed instead of loading them all into memory.
+        threshold = self._range_fastpath_threshold
+        rows = list(q[: threshold + 1])
+        if not rows:
+            return self.none()
+        if len(rows) > threshold:
+            rows = chain(rows, q[len(rows) :].iterator(chunk_size=2000))
+        ranges = _sibling_ranges(rows, min_index, max_index)
+
+        # Filter on each tree id once, rather than repeating it for every
+        # range in that tree.
+        tree_filters = [
+            Q(**{tree_key: tree})
+            & functools.reduce(
+                operator.or_,
+                (
+                    Q(**{min_key: min_val, max_key: max_val})
+                    for min_val, max_val in tree_ranges
+                ),
             )
+            for tree, tree_ranges in ranges.items()
+        ]
 
-        return self.filter(filters)
+        return self.filter(functools.reduce(operator.or_, tree_filters))
 
     def get_queryset_descendants(self, queryset, include_self=False):
         """
@@ -346,6 +561,63 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
                 for tree_id in results:
                     partial_rebuild(tree_id)
 
+    @contextlib.contextmanager
+    def buffered_space(self):
+        """
+        Context manager. Buffers the space created and the gaps closed in
+        trees while inserting nodes, and applies them at the end of the block
+        with a single UPDATE per tree.
+
+        NOTE that the database is not updated until the end of the block, so
+        inside it the left and right values of existing nodes are stale.
+
+        When to use this method:
+            Inserting many nodes into an existing tree one at a time issues an
+            UPDATE for every insertion.  Inside this block the insertions must
+            work from the values cached on the target nodes (pass
+            ``refresh_target=False``), and the new nodes must be saved after
+            the block, as otherwise they would be shifted again when the space
+            is created.  The nodes inserted in the block are kept up to date
+            as further nodes are inserted before them.  Gaps may be closed with ``_close_gap()`` as well, but
+            don't delete saved nodes inside the block, as they read their
+            values from the database.  Moving nodes, including saving them
+            with a new parent, and inserting root nodes next to existing ones
+            raise ``InvalidMove``::
+
+                with MyNode.objects.buffered_space():
+                    for node in nodes:
+                        MyNode.objects.insert_node(
+                            node, parent, save=False, refresh_target=False
+                        )
+                MyNode.objects.bulk_create(nodes)
+
+        Transactions:
+            This doesn't enforce any transactional behavior.  You should wrap
+            this in a transaction to ensure database consistency.
+
+        Exceptions:
+            If an exception occurs before the processing of the block, the
+            buffered space will not be created.
+
+        If space is already being buffered, this is a noop.
+        """
+        threadlocal = self.tree_model._threadlocal
+        if getattr(threadlocal, "mptt_space_buffer", None) is not None:
+            # already buffering, noop.
+            yield
+            return
+
+        threadlocal.mptt_space_buffer = []
+        threadlocal.mptt_buffered_nodes = []
+        try:
+            yield
+            spaces = threadlocal.mptt_space_buffer
+        finally:
+            # the buffered space is discarded if the block didn't complete.
+            threadlocal.mptt_space_buffer = None
+            threadlocal.mptt_buffered_nodes = None
+        self._manage_space_batch(spaces)
+
     @property
     def parent_attr(self):
         return self.model._mptt_meta.parent_attr
@@ -367,16 +639,8 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         return self.model._mptt_meta.level_attr
 
     def _translate_lookups(self, **lookups):
-        new_lookups = {}
-        join_parts = "__".join
-        for k, v in lookups.items():
-            parts = k.split("__")
-            new_parts = []
-            new_parts__append = new_parts.append
-            for part in parts:
-                new_parts__append(getattr(self, part + "_attr", part))
-            new_lookups[join_parts(new_parts)] = v
-        return new_lookups
+        mptt_meta = self.model._mptt_meta
+        return {_translate_lookup(mptt_meta, k): v for k, v in lookups.items()}
 
     @delegate_manager
     def _mptt_filter(self, qs=None, **filters):
@@ -400,6 +664,46 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
     def _get_connection(self, **hints):
         return connections[router.db_for_write(self.model, **hints)]
 
+    def _clean_tree_ids(self, connection, *tree_ids):
+        """
+        Returns ``tree_ids`` as they are passed to raw SQL run on
+        ``connection``, as ``clean_tree_ids`` does.
+        """
+        if (
+            self.model._mptt_meta.root_node_ordering
+            or connection.vendor == "postgresql"
+        ):
+            # integer ids, and UUIDs on PostgreSQL, are passed as they are.
+            return tree_ids if len(tree_ids) > 1 else tree_ids[0]
+        return clean_tree_ids(*tree_ids, vendor=connection.vendor)
+
+    def _get_sql_templates(self, connection):
+        """
+        Returns the raw SQL used to rearrange trees, along with the quoted
+        table and column names, for ``connection``. These only depend on the
+        model and the database backend, so they are built once per alias.
+        """
+        try:
+            return self._sql_templates[connection.alias]
+        except KeyError:
+            pass
+
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        names = {
+            "table": qn(self.tree_model._meta.db_table),
+            "level": qn(opts.get_field(self.level_attr).column),
+            "left": qn(opts.get_field(self.left_attr).column),
+            "right": qn(opts.get_field(self.right_attr).column),
+            "tree_id": qn(opts.get_field(self.tree_id_attr).column),
+        }
+        templates = {
+            name: template.format(**names) for name, template in _SQL_TEMPLATES.items()
+        }
+        templates.update(names)
+        self._sql_templates[connection.alias] = templates
+        return templates
+
     def add_related_count(
         self,
         queryset,
@@ -494,7 +798,11 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
 
         root_node_ordering = self.model._mptt_meta.root_node_ordering
 
-        if node.pk and not allow_existing_pk and self.filter(pk=node.pk).exists():
+        if (
+            node.pk
+            and not allow_existing_pk
+            and self._unordered_queryset().filter(pk=node.pk).exists()
+        ):
             raise ValueError(_("Cannot insert a node which has already been saved."))
 
         if target is None:
@@ -552,6 +860,8 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
             if parent:
                 self._post_insert_update_cached_parent_right(parent, right_shift)
 
+        self._buffer_inserted_node(node)
+
         if save:
             node.save()
         return node
@@ -571,6 +881,11 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
                 refresh_target=refresh_target,
             )
         else:
+            # moves work from the left and right values in the database,
+            # which are stale while space is buffered.
+            self._check_space_not_buffered(
+                _("A node may not be moved while space is buffered.")
+            )
             if target is None:
                 if node.is_child_node():
                     self._make_child_root_node(node)
@@ -616,7 +931,9 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         """
         Returns the root node of the tree with the given id.
         """
-        return self._mptt_filter(tree_id=tree_id, parent=None).get()
+        return self._mptt_filter(
+            self._unordered_queryset(), tree_id=tree_id, parent=None
+        ).get()
 
     @delegate_manager
     def root_nodes(self):
@@ -628,93 +945,194 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
     def _find_out_rebuild_fields(self):
         """
         Due to the behavior of the metaclass, it is not possible
-        to find out the fields in the __init__ correctly.
+        to find out the fields in the __init__ correctly, so this is called
+        from ``contribute_to_class()`` instead.
         """
         lookups = self._translate_lookups(
             left="left", right="right", level="level", tree_id="tree_id"
         )
         self._rebuild_fields = {value: key for key, value in lookups.items()}
 
-    def _get_parents(self, **filters):
-        opts = self.model._mptt_meta
-        qs = self._mptt_filter(parent=None, **filters)
-        if opts.order_insertion_by:
-            qs = qs.order_by(*opts.order_insertion_by)
-        return list(qs.only("pk"))
-
-    def _get_children(self, **filters):
+    def _get_parents_and_children(self, **filters):
+        """
+        Returns the pks of the root nodes matching ``filters`` and a mapping
+        of parent pks to the pks of their children, both in insertion order,
+        using a single query.
+        """
         opts = self.model._mptt_meta
-        qs = self._mptt_filter(parent__isnull=False, **filters)
         if opts.order_insertion_by:
-            qs = qs.order_by(*opts.order_insertion_by)
+            qs = self._mptt_filter(self._unordered_queryset(), **filters).order_by(
+                *opts.order_insertion_by
+            )
+        else:
+            # keep the current tree order, so trees keep their relative order.
+            qs = self._mptt_filter(**filters)
 
+        # Only pks are needed to rebuild, so don't instantiate any models.
+        # Selecting the relation yields the raw parent id, without a join.
+        parents = []
         children = defaultdict(list)
-        for child in qs.select_related(opts.parent_attr):
-            children[getattr(child, opts.parent_attr).pk].append(child)
-        return children
+        for pk, parent_id in qs.values_list("pk", opts.parent_attr).iterator():
+            if parent_id is None:
+                parents.append(pk)
+            else:
+                children[parent_id].append(pk)
+        return parents, children
 
     @delegate_manager
-    def rebuild(self, batch_size=1000, **filters) -> None:
+    def rebuild(self, batch_size=None, **filters) -> None:
         """
         Rebuilds all trees in the database table using `parent` link.
-        """
-        self._find_out_rebuild_fields()
 
-        parents = self._get_parents(**filters)
-        children = self._get_children(**filters)
+        If django-fast-update is installed, the new values are written with
+        ``copy_update()`` on PostgreSQL and ``fast_update()`` elsewhere, in
+        batches of 50000 rows by default. Otherwise ``bulk_update()`` is used,
+        in batches of 1000 rows by default.
+        """
+        parents, children = self._get_parents_and_children(**filters)
+        self._forget_next_tree_id()
 
         # forked modification
-        tree_id = filters.get("tree_id", 1)
-        nodes_to_update = []
-        for index, parent in enumerate(parents):
-            self._rebuild_helper(
-                node=parent,
+        if self.model._mptt_meta.root_node_ordering:
+            tree_id = filters.get("tree_id", 1)
+            root_tree_ids = range(tree_id, tree_id + len(parents))
+        else:
+            # same as calling uuid.uuid4() per tree, with a single read of
+            # random bytes.
+            random_bytes = os.urandom(16 * len(parents))
+            root_tree_ids = [
+                uuid.UUID(bytes=random_bytes[offset : offset + 16], version=4)
+                for offset in range(0, len(random_bytes), 16)
+            ]
+
+        # every fetched node is written at most once, so size the columns
+        # up front and fill them by index.
+        total = len(parents) + sum(map(len, children.values()))
+        columns = tuple([None] * total for _ in range(5))
+        index = 0
+        for parent_pk, tree_id in zip(parents, root_tree_ids):
+            index = self._rebuild_helper(
+                node_pk=parent_pk,
                 left=1,
-                tree_id=tree_id + index if self.model._mptt_meta.root_node_ordering else uuid.uuid4(),
+                tree_id=tree_id,
                 children=children,
-                nodes_to_update=nodes_to_update,
+                columns=columns,
+                index=index,
                 level=0,
             )
-        self.bulk_update(
-            nodes_to_update,
-            self._rebuild_fields.values(),
+        pks, lefts, rights, levels, tree_ids = columns
+        if index < total:
+            # nodes whose parent wasn't fetched aren't reachable from a root.
+            for column in columns:
+                del column[index:]
+        self._update_rebuilt_fields(
+            pks,
+            {
+                self._rebuild_fields["left"]: lefts,
+                self._rebuild_fields["right"]: rights,
+                self._rebuild_fields["level"]: levels,
+                self._rebuild_fields["tree_id"]: tree_ids,
+            },
             batch_size=batch_size,
         )
 
     rebuild.alters_data = True
 
-    def _rebuild_helper(self, node, left, tree_id, children, nodes_to_update, level):
-        right = left + 1
-
-        for child in children[node.pk]:
-            right = self._rebuild_helper(
-                node=child,
-                left=right,
-                tree_id=tree_id,
-                children=children,
-                nodes_to_update=nodes_to_update,
-                level=level + 1,
-            )
+    def _rebuild_helper(self, node_pk, left, tree_id, children, columns, index, level):
+        """
+        Walks the subtree below the node with ``node_pk`` depth-first (using
+        ``children`` to map pks to the pks of their children) and stores the
+        pk, left, right, level and tree id of every node in it in the five
+        lists in ``columns`` (children before their parents), starting at
+        ``index``. Returns the index following the last stored node.
+
+        An explicit stack is used instead of recursion, so arbitrarily deep
+        trees don't hit the interpreter's recursion limit.
+        """
+        pks, lefts, rights, levels, tree_ids = columns
+
+        # Each stack entry is ``(pk, iterator over its children, left, level)``
+        # and ``next_values`` holds the next unused value inside that node.
+        stack = [(node_pk, iter(children[node_pk]), left, level)]
+        next_values = [left + 1]
+        while stack:
+            node_pk, node_children, left, level = stack[-1]
+            child_pk = next(node_children, None)
+            if child_pk is not None:
+                child_left = next_values[-1]
+                stack.append(
+                    (child_pk, iter(children[child_pk]), child_left, level + 1)
+                )
+                next_values.append(child_left + 1)
+                continue
+
+            stack.pop()
+            right = next_values.pop()
+            pks[index] = node_pk
+            lefts[index] = left
+            rights[index] = right
+            levels[index] = level
+            tree_ids[index] = tree_id
+            index += 1
+            if next_values:
+                next_values[-1] = right + 1
+
+        return index
+
+    def _update_rebuilt_fields(self, pks, values, batch_size=None):
+        """
+        Writes the tree fields computed by ``rebuild()`` to the database.
 
-        setattr(node, self._rebuild_fields["left"], left)
-        setattr(node, self._rebuild_fields["right"], right)
-        setattr(node, self._rebuild_fields["level"], level)
-        setattr(node, self._rebuild_fields["tree_id"], tree_id)
-        nodes_to_update.append(node)
+        ``values`` maps field names to lists of values, in the same order as
+        ``pks``. Only these fields are loaded on the (deferred) model instance
+        built for every node.
+        """
+        if not pks:
+            return
+        db = self._db or router.db_for_write(self.model)
+        field_names = []
+        columns = []
+        for field in self.model._meta.concrete_fields:
+            if field.primary_key:
+                field_names.append(field.attname)
+                columns.append(pks)
+            elif field.name in values:
+                field_names.append(field.attname)
+                columns.append(values[field.name])
+        objs = [self.model.from_db(db, field_names, row) for row in zip(*columns)]
+
+        fields = list(values)
+        if FastUpdateQuerySet is None:
+            if batch_size is None:
+                batch_size = 1000
+            self.using(db).bulk_update(objs, fields, batch_size=batch_size)
+            return
 
-        return right + 1
+        if batch_size is None:
+            batch_size = 50000
+        queryset = FastUpdateQuerySet(self.model, using=db)
+        with transaction.atomic(using=db, savepoint=False):
+            if connections[db].vendor == "postgresql":
+                queryset.copy_update(objs, fields)
+            else:
+                queryset.fast_update(objs, fields, batch_size=batch_size)
 
     @delegate_manager
-    def partial_rebuild(self, tree_id, batch_size=1000, **filters):
+    def partial_rebuild(self, tree_id, batch_size=None, **filters):
         """
         Partially rebuilds a tree i.e. It rebuilds only the tree with given
         ``tree_id`` in database table using ``parent`` link.
         """
-        count = self._mptt_filter(parent=None, tree_id=tree_id, **filters).count()
+        # only whether there are no, one or several roots matters.
+        roots = list(
+            self._mptt_filter(
+                self._unordered_queryset(), parent=None, tree_id=tree_id, **filters
+            ).values_list("pk", flat=True)[:2]
+        )
 
-        if count == 0:
+        if not roots:
             return
-        elif count == 1:
+        elif len(roots) == 1:
             self.rebuild(batch_size=batch_size, tree_id=tree_id, **filters)
         else:
             raise RuntimeError(
@@ -773,52 +1191,94 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
             level = 0
 
         stack = []
-
-        def treeify(data, cursor=1, level=0):
-            data = dict(data)
-            children = data.pop("children", [])
-            node = self.model(**data)
+        tree_id_attr = opts.tree_id_attr
+        level_attr = opts.level_attr
+        left_attr = opts.left_attr
+        right_attr = opts.right_attr
+
+        # each entry is (data, level, node); node is None until the entry has
+        # been visited, after which it is revisited once its children are done
+        # to assign the right value.
+        pending = [(data, level, None)]
+        value = cursor - 1
+        while pending:
+            item, item_level, node = pending.pop()
+            value += 1
+            if node is not None:
+                setattr(node, right_attr, value)
+                continue
+            node = self.model(**{k: v for k, v in item.items() if k != "children"})
             stack.append(node)
-            setattr(node, opts.tree_id_attr, tree_id)
-            setattr(node, opts.level_attr, level)
-            setattr(node, opts.left_attr, cursor)
-            for child in children:
-                cursor = treeify(child, cursor=cursor + 1, level=level + 1)
-            cursor += 1
-            setattr(node, opts.right_attr, cursor)
-            return cursor
-
-        treeify(data, cursor=cursor, level=level)
+            setattr(node, tree_id_attr, tree_id)
+            setattr(node, level_attr, item_level)
+            setattr(node, left_attr, value)
+            pending.append((item, item_level, node))
+            pending.extend(
+                reversed(
+                    [
+                        (child, item_level + 1, None)
+                        for child in item.get("children", ())
+                    ]
+                )
+            )
 
         if target:
             self._create_space(2 * len(stack), cursor - 1, tree_id)
 
         return stack
 
-    def _post_insert_update_cached_parent_right(self, instance, right_shift, seen=None):
-        setattr(
-            instance, self.right_attr, getattr(instance, self.right_attr) + right_shift
-        )
-        parent = cached_field_value(instance, self.parent_attr)
-        if parent:
-            if not seen:
+    def _post_insert_update_cached_parent_right(self, instance, right_shift):
+        right_attr = self.right_attr
+        parent_attr = self.parent_attr
+        seen = None
+        while True:
+            setattr(instance, right_attr, getattr(instance, right_attr) + right_shift)
+            parent = cached_field_value(instance, parent_attr)
+            if not parent:
+                break
+            if seen is None:
                 seen = set()
             seen.add(instance)
             if parent in seen:
-                # detect infinite recursion and throw an error
+                # detect cycles in the cached parents and throw an error
                 raise InvalidMove
-            self._post_insert_update_cached_parent_right(parent, right_shift, seen=seen)
+            instance = parent
+
+    def _set_node_state(self, node, left, right, level, tree_id, parent):
+        """
+        Updates ``node`` to be consistent with its new tree state in the
+        database.
+        """
+        attrs = (self.left_attr, self.right_attr, self.level_attr, self.tree_id_attr)
+        if self._node_state_in_dict is None:
+            # Django's own field descriptors leave setting values to the
+            # instance __dict__, so there is nothing to bypass.
+            self._node_state_in_dict = (
+                self.model.__setattr__ is object.__setattr__
+                and all(
+                    type(getattr(self.model, attr, None)) is DeferredAttribute
+                    for attr in attrs
+                )
+            )
+        if self._node_state_in_dict:
+            node.__dict__.update(zip(attrs, (left, right, level, tree_id)))
+        else:
+            for attr, value in zip(attrs, (left, right, level, tree_id)):
+                setattr(node, attr, value)
+        setattr(node, self.parent_attr, parent)
+        node._mptt_cached_fields[self.parent_attr] = (
+            None if parent is None else parent.pk
+        )
 
     def _calculate_inter_tree_move_values(self, node, target, position):
         """
         Calculates values required when moving ``node`` relative to
         ``target`` as specified by ``position``.
         """
-        left = getattr(node, self.left_attr)
-        level = getattr(node, self.level_attr)
-        target_left = getattr(target, self.left_attr)
-        target_right = getattr(target, self.right_attr)
-        target_level = getattr(target, self.level_attr)
+        left, right, level, _tree_id = self._node_state(node)
+        target_left, target_right, target_level, _target_tree_id = self._node_state(
+            target
+        )
 
         if position == "last-child" or position == "first-child":
             space_target = target_right - 1 if position == "last-child" else target_left
@@ -835,7 +1295,9 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
 
         right_shift = 0
         if parent:
-            right_shift = 2 * (node.get_descendant_count() + 1)
+            # twice the node's descendant count plus one, as worked out by
+            # get_descendant_count(), without the repeated field lookups.
+            right_shift = 2 if right is None else 2 * ((right - left - 1) // 2 + 1)
 
         return space_target, level_change, left_right_change, parent, right_shift
 
@@ -858,7 +1320,11 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         Creates space for a new tree by incrementing all tree ids
         greater than ``target_tree_id``.
         """
-        qs = self._mptt_filter(tree_id__gt=target_tree_id)
+        # the buffered space is kept by tree id.
+        self._check_space_not_buffered(
+            _("Trees may not be renumbered while space is buffered.")
+        )
+        qs = self._mptt_filter(self._unordered_queryset(), tree_id__gt=target_tree_id)
         self._mptt_update(qs, tree_id=F(self.tree_id_attr) + num_trees)
         self.tree_model._mptt_track_tree_insertions(target_tree_id + 1, num_trees)
 
@@ -871,9 +1337,43 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         if not self.model._mptt_meta.root_node_ordering:
             return self.model._meta.get_field(self.tree_id_attr).default()
 
-        max_tree_id = next(iter(self.aggregate(Max(self.tree_id_attr)).values()))
-        max_tree_id = max_tree_id or 0
-        return max_tree_id + 1
+        tree_model = self.tree_model
+        if tree_model._mptt_is_tracking:
+            # tree ids are handed out here for the whole block, so only the
+            # first new root needs to ask the database.
+            next_tree_id = tree_model._threadlocal.mptt_next_tree_id
+            if next_tree_id is None:
+                next_tree_id = self._get_max_tree_id() + 1
+            tree_model._threadlocal.mptt_next_tree_id = next_tree_id + 1
+            return next_tree_id
+
+        return self._get_max_tree_id() + 1
+
+    def _get_max_tree_id(self):
+        max_tree_id = next(
+            iter(self._unordered_queryset().aggregate(Max(self.tree_id_attr)).values())
+        )
+        return max_tree_id or 0
+
+    def _forget_next_tree_id(self):
+        """
+        Discards the next tree id remembered by ``_get_next_tree_id()`` while
+        tree updates are delayed, so the next new tree queries the database
+        again.
+        """
+        self.tree_model._threadlocal.mptt_next_tree_id = None
+
+    @delegate_manager
+    def _tree_id_used(self, tree_id):
+        """
+        Called when a new root is saved with a tree id which wasn't handed
+        out by ``_get_next_tree_id()``, to keep the next tree id remembered
+        while tree updates are delayed ahead of it.
+        """
+        threadlocal = self.tree_model._threadlocal
+        next_tree_id = getattr(threadlocal, "mptt_next_tree_id", None)
+        if next_tree_id is not None and tree_id is not None and tree_id >= next_tree_id:
+            threadlocal.mptt_next_tree_id = tree_id + 1
 
     def _inter_tree_move_and_close_gap(
         self, node, level_change, left_right_change, new_tree_id
@@ -884,49 +1384,15 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         the gap left by moving ``node`` as it does so.
         """
         connection = self._get_connection(instance=node)
-        qn = connection.ops.quote_name
-
-        opts = self.model._meta
-        root_ordering = self.model._mptt_meta.root_node_ordering
-        inter_tree_move_query = """
-        UPDATE {table}
-        SET {level} = CASE
-                WHEN {left} >= %s AND {left} <= %s
-                    THEN {level} - %s
-                ELSE {level} END,
-            {tree_id} = CASE
-                WHEN {left} >= %s AND {left} <= %s
-                    THEN %s
-                ELSE {tree_id} END,
-            {left} = CASE
-                WHEN {left} >= %s AND {left} <= %s
-                    THEN {left} - %s
-                WHEN {left} > %s
-                    THEN {left} - %s
-                ELSE {left} END,
-            {right} = CASE
-                WHEN {right} >= %s AND {right} <= %s
-                    THEN {right} - %s
-                WHEN {right} > %s
-                    THEN {right} - %s
-                ELSE {right} END
-        WHERE {tree_id} = %s""".format(
-            table=qn(self.tree_model._meta.db_table),
-            level=qn(opts.get_field(self.level_attr).column),
-            left=qn(opts.get_field(self.left_attr).column),
-            tree_id=qn(opts.get_field(self.tree_id_attr).column),
-            right=qn(opts.get_field(self.right_attr).column),
-        )
 
         left = getattr(node, self.left_attr)
         right = getattr(node, self.right_attr)
         gap_size = right - left + 1
         gap_target_left = left - 1
-        new_tree_id, current_tree_id = clean_tree_ids(
+        new_tree_id, current_tree_id = self._clean_tree_ids(
+            connection,
             new_tree_id,
             getattr(node, self.tree_id_attr),
-            root_ordering=root_ordering,
-            vendor=connection.vendor
         )
         params = [
             left,
@@ -948,8 +1414,210 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
             current_tree_id
         ]
 
-        cursor = connection.cursor()
-        cursor.execute(inter_tree_move_query, params)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self._get_sql_templates(connection)["inter_tree_move"], params
+            )
+
+    def _move_to_other_tree(
+        self, node, level_change, left_right_change, new_tree_id, space_target
+    ):
+        """
+        Moves ``node`` and its descendants to the tree identified by
+        ``new_tree_id``, after the ``space_target`` point, with the given set
+        of changes being applied to them, closing the gap left by moving
+        ``node`` as it does so.
+
+        This is a single UPDATE of both trees, except with MySQL, which
+        evaluates each assignment against the already updated columns, so
+        the space is created and the nodes are moved with separate queries.
+        """
+        connection = self._get_connection(instance=node)
+        if not self._can_fuse_tree_moves(connection):
+            left = getattr(node, self.left_attr)
+            right = getattr(node, self.right_attr)
+            self._create_space(right - left + 1, space_target, new_tree_id)
+            self._inter_tree_move_and_close_gap(
+                node, level_change, left_right_change, new_tree_id
+            )
+            return
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                self._get_sql_templates(connection)["move_to_other_tree"],
+                self._move_to_other_tree_params(
+                    connection,
+                    node,
+                    level_change,
+                    left_right_change,
+                    new_tree_id,
+                    space_target,
+                ),
+            )
+
+    def _check_space_not_buffered(self, message):
+        space_buffer = getattr(self.tree_model._threadlocal, "mptt_space_buffer", None)
+        if space_buffer is not None:
+            raise InvalidMove(message)
+
+    def _can_fuse_tree_moves(self, connection):
+        return connection.vendor != "mysql"
+
+    def _move_to_other_tree_params(
+        self,
+        connection,
+        node,
+        level_change,
+        left_right_change,
+        new_tree_id,
+        space_target,
+    ):
+        left = getattr(node, self.left_attr)
+        right = getattr(node, self.right_attr)
+        width = right - left + 1
+        new_tree_id, current_tree_id = self._clean_tree_ids(
+            connection,
+            new_tree_id,
+            getattr(node, self.tree_id_attr),
+        )
+        gap_target_left = left - 1
+        subtree = [current_tree_id, left, right]
+        return [
+            *subtree,
+            level_change,
+            new_tree_id,
+            space_target,
+            width,
+            *subtree,
+            left_right_change,
+            current_tree_id,
+            gap_target_left,
+            width,
+            new_tree_id,
+            space_target,
+            width,
+            *subtree,
+            left_right_change,
+            current_tree_id,
+            gap_target_left,
+            width,
+            *subtree,
+            new_tree_id,
+            current_tree_id,
+            new_tree_id,
+        ]
+
+    @delegate_manager
+    def _bulk_move_to_tree(self, nodes, target, position="last-child"):
+        """
+        Moves each of the given ``nodes`` in turn to the given ``target``
+        node, as specified by ``position`` (``'first-child'`` or
+        ``'last-child'``), with the same result as moving them one at a time.
+
+        ``target`` must be in a different tree from all of ``nodes``, and
+        none of ``nodes`` may be a descendant of another. As the moves can't
+        affect each other in other ways, the positions are worked out in
+        Python and every move is sent with a single ``executemany()``.
+
+        ``nodes`` and ``target`` will be modified to reflect their new tree
+        state in the database, including their new parent.
+        """
+        if position not in ("first-child", "last-child"):
+            raise ValueError(_("An invalid position was given: %s.") % position)
+
+        target_tree_id = getattr(target, self.tree_id_attr)
+        trees = defaultdict(list)
+        for node in nodes:
+            if getattr(node, self.tree_id_attr) == target_tree_id:
+                raise InvalidMove(
+                    _("A node may not be moved within its tree with this method.")
+                )
+            trees[getattr(node, self.tree_id_attr)].append(
+                (getattr(node, self.left_attr), getattr(node, self.right_attr))
+            )
+        for subtrees in trees.values():
+            subtrees.sort()
+            for (_left, right), (next_left, _right) in zip(subtrees, subtrees[1:]):
+                if next_left < right:
+                    raise InvalidMove(
+                        _("A node may not be moved along with its descendants.")
+                    )
+
+        if self.tree_model._mptt_is_tracking:
+            for node in nodes:
+                self._move_node(node, target, position)
+        else:
+            self._check_space_not_buffered(
+                _("A node may not be moved while space is buffered.")
+            )
+            self._bulk_move_to_other_tree(nodes, target, position)
+
+        self._unordered_queryset().filter(pk__in=[node.pk for node in nodes]).update(
+            **{self.parent_attr: target}
+        )
+
+    def _bulk_move_to_other_tree(self, nodes, target, position):
+        target_tree_id = getattr(target, self.tree_id_attr)
+        connection = self._get_connection(instance=target)
+        fuse = self._can_fuse_tree_moves(connection)
+        params = []
+        # the (right, width) of the nodes already moved out of each tree,
+        # using the values from before any of the moves.
+        moved = defaultdict(list)
+        for i, node in enumerate(nodes):
+            left, right, level, tree_id = self._node_state(node)
+            width = right - left + 1
+            # the gaps left by nodes moved out before this one were closed.
+            shift = sum(w for r, w in moved[tree_id] if r < left)
+            moved[tree_id].append((right, width))
+            left -= shift
+            right -= shift
+            setattr(node, self.left_attr, left)
+            setattr(node, self.right_attr, right)
+
+            (
+                space_target,
+                level_change,
+                left_right_change,
+                parent,
+                right_shift,
+            ) = self._calculate_inter_tree_move_values(node, target, position)
+            if fuse:
+                params.append(
+                    self._move_to_other_tree_params(
+                        connection,
+                        node,
+                        level_change,
+                        left_right_change,
+                        target_tree_id,
+                        space_target,
+                    )
+                )
+            else:
+                self._move_to_other_tree(
+                    node, level_change, left_right_change, target_tree_id, space_target
+                )
+
+            self._set_node_state(
+                node,
+                left - left_right_change,
+                right - left_right_change,
+                level - level_change,
+                target_tree_id,
+                parent,
+            )
+            setattr(target, self.right_attr, getattr(target, self.right_attr) + width)
+            if position == "first-child":
+                # the nodes moved before this one now come after it.
+                for moved_node in nodes[:i]:
+                    for attr in (self.left_attr, self.right_attr):
+                        setattr(moved_node, attr, getattr(moved_node, attr) + width)
+
+        if params:
+            with connection.cursor() as cursor:
+                cursor.executemany(
+                    self._get_sql_templates(connection)["move_to_other_tree"], params
+                )
 
     def _make_child_root_node(self, node, new_tree_id=None):
         """
@@ -962,9 +1630,7 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         ``node`` will be modified to reflect its new tree state in the
         database.
         """
-        left = getattr(node, self.left_attr)
-        right = getattr(node, self.right_attr)
-        level = getattr(node, self.level_attr)
+        left, right, level, _tree_id = self._node_state(node)
         if not new_tree_id:
             new_tree_id = self._get_next_tree_id()
         left_right_change = left - 1
@@ -973,12 +1639,14 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
 
         # Update the node to be consistent with the updated
         # tree in the database.
-        setattr(node, self.left_attr, left - left_right_change)
-        setattr(node, self.right_attr, right - left_right_change)
-        setattr(node, self.level_attr, 0)
-        setattr(node, self.tree_id_attr, new_tree_id)
-        setattr(node, self.parent_attr, None)
-        node._mptt_cached_fields[self.parent_attr] = None
+        self._set_node_state(
+            node,
+            left - left_right_change,
+            right - left_right_change,
+            0,
+            new_tree_id,
+            None,
+        )
 
     def _make_sibling_of_root_node(self, node, target, position):
         """
@@ -996,8 +1664,6 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         if node == target:
             raise InvalidMove(_("A node may not be made a sibling of itself."))
 
-        opts = self.model._meta
-        root_ordering = self.model._mptt_meta.root_node_ordering
         tree_id = getattr(node, self.tree_id_attr)
         target_tree_id = getattr(target, self.tree_id_attr)
 
@@ -1011,6 +1677,13 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
             else:
                 raise ValueError(_("An invalid position was given: %s.") % position)
 
+            connection = self._get_connection(instance=node)
+            if self._can_fuse_tree_moves(connection):
+                self._move_child_to_root_sibling(
+                    connection, node, space_target, new_tree_id
+                )
+                return
+
             self._create_tree_space(space_target)
             if tree_id > space_target:
                 # The node's tree id has been incremented in the
@@ -1020,8 +1693,13 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
                 setattr(node, self.tree_id_attr, tree_id + 1)
             self._make_child_root_node(node, new_tree_id)
         else:
+            # with integer tree ids, the distance between adjacent roots is 1.
+            root_ordering = self.model._mptt_meta.root_node_ordering
             if position == "left":
-                if target_tree_id > tree_id:
+                if root_ordering and target_tree_id == tree_id + 1:
+                    # the node already is the target's left sibling.
+                    return
+                elif target_tree_id > tree_id:
                     left_sibling = target.get_previous_sibling()
                     if node == left_sibling:
                         return
@@ -1033,7 +1711,10 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
                     lower_bound, upper_bound = new_tree_id, tree_id
                     shift = 1
             elif position == "right":
-                if target_tree_id > tree_id:
+                if root_ordering and target_tree_id == tree_id - 1:
+                    # the node already is the target's right sibling.
+                    return
+                elif target_tree_id > tree_id:
                     new_tree_id = target_tree_id
                     lower_bound, upper_bound = tree_id, target_tree_id
                     shift = -1
@@ -1048,32 +1729,75 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
                 raise ValueError(_("An invalid position was given: %s.") % position)
 
             connection = self._get_connection(instance=node)
-            qn = connection.ops.quote_name
-
-            root_sibling_query = """
-            UPDATE {table}
-            SET {tree_id} = CASE
-                WHEN {tree_id} = %s
-                    THEN %s
-                ELSE {tree_id} + %s END
-            WHERE {tree_id} >= %s AND {tree_id} <= %s""".format(
-                table=qn(self.tree_model._meta.db_table),
-                tree_id=qn(opts.get_field(self.tree_id_attr).column),
-            )
 
-            cleaned_tree_id, cleaned_new_tree_id = clean_tree_ids(
+            cleaned_tree_id, cleaned_new_tree_id = self._clean_tree_ids(
+                connection,
                 tree_id,
                 new_tree_id,
-                root_ordering=root_ordering,
-                vendor=connection.vendor
             )
 
-            cursor = connection.cursor()
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    self._get_sql_templates(connection)["root_sibling"],
+                    [
+                        cleaned_tree_id,
+                        cleaned_new_tree_id,
+                        shift,
+                        lower_bound,
+                        upper_bound,
+                    ],
+                )
+            setattr(node, self.tree_id_attr, new_tree_id)
+
+    def _move_child_to_root_sibling(self, connection, node, space_target, new_tree_id):
+        """
+        Makes child node ``node`` the root of a new tree with the given
+        ``new_tree_id``, shifting up the tree ids greater than
+        ``space_target`` to make room for it, with a single query.
+
+        ``node`` will be modified to reflect its new tree state in the
+        database.
+        """
+        left, right, level, tree_id = self._node_state(node)
+        left_right_change = left - 1
+        gap_size = right - left + 1
+        current_tree_id, cleaned_new_tree_id = self._clean_tree_ids(
+            connection, tree_id, new_tree_id
+        )
+        subtree = [current_tree_id, left, right]
+        with connection.cursor() as cursor:
             cursor.execute(
-                root_sibling_query,
-                [cleaned_tree_id, cleaned_new_tree_id, shift, lower_bound, upper_bound],
+                self._get_sql_templates(connection)["child_to_root_sibling"],
+                [
+                    *subtree,
+                    level,
+                    *subtree,
+                    left_right_change,
+                    current_tree_id,
+                    right,
+                    gap_size,
+                    *subtree,
+                    left_right_change,
+                    current_tree_id,
+                    right,
+                    gap_size,
+                    *subtree,
+                    cleaned_new_tree_id,
+                    space_target,
+                    current_tree_id,
+                    space_target,
+                ],
             )
-            setattr(node, self.tree_id_attr, new_tree_id)
+        self.tree_model._mptt_track_tree_insertions(space_target + 1, 1)
+
+        self._set_node_state(
+            node,
+            left - left_right_change,
+            right - left_right_change,
+            0,
+            new_tree_id,
+            None,
+        )
 
     def _manage_space(self, size, target, tree_id):
         """
@@ -1081,47 +1805,123 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         the values of the left and right columns by ``size`` after the
         given ``target`` point.
         """
+        if not size:
+            return
+
         if self.tree_model._mptt_is_tracking:
             self.tree_model._mptt_track_tree_modified(tree_id)
+            return
+
+        threadlocal = self.tree_model._threadlocal
+        space_buffer = getattr(threadlocal, "mptt_space_buffer", None)
+        if space_buffer is not None:
+            space_buffer.append((size, target, tree_id))
+            # the nodes inserted in the block aren't in the database yet, so
+            # those after the target are shifted here. Their ancestors are
+            # updated through the cached parents on insertion.
+            for node in threadlocal.mptt_buffered_nodes:
+                left, right, _level, node_tree_id = self._node_state(node)
+                if node_tree_id == tree_id and left > target:
+                    setattr(node, self.left_attr, left + size)
+                    setattr(node, self.right_attr, right + size)
         else:
-            connection = self._get_connection()
-            qn = connection.ops.quote_name
+            self._shift_tree_values(tree_id, [(target, size)])
 
-            opts = self.model._meta
-            root_ordering = self.model._mptt_meta.root_node_ordering
-            space_query = """
+    def _buffer_inserted_node(self, node):
+        """
+        Remembers ``node`` if space is being buffered, so that its values are
+        shifted by ``_manage_space()`` as further nodes are inserted.
+        """
+        buffered_nodes = getattr(
+            self.tree_model._threadlocal, "mptt_buffered_nodes", None
+        )
+        if buffered_nodes is not None:
+            buffered_nodes.append(node)
+
+    def _manage_space_batch(self, spaces):
+        """
+        Applies the space changes given as ``(size, target, tree_id)`` tuples,
+        with the same result as calling ``_manage_space`` for each of them in
+        order, but with at most a single UPDATE per tree. A negative ``size``
+        closes a gap.
+
+        Each ``target`` is relative to the tree as left by the changes before
+        it, so it is mapped back to the current values in the database before
+        the shifts are combined.
+        """
+        trees = defaultdict(list)
+        for size, target, tree_id in spaces:
+            trees[tree_id].append((size, target))
+
+        for tree_id, tree_spaces in trees.items():
+            shifts = defaultdict(int)
+            for index, (size, target) in enumerate(tree_spaces):
+                for previous_size, previous_target in reversed(tree_spaces[:index]):
+                    # a closed gap removed the values just before its target.
+                    if target > previous_target + previous_size:
+                        target -= previous_size
+                    elif target > previous_target:
+                        target = previous_target
+                shifts[target] += size
+
+            # values after each threshold are shifted by the space created
+            # at that threshold and at every threshold before it.
+            cumulative = []
+            total = 0
+            for target in sorted(shifts):
+                total += shifts[target]
+                cumulative.append((target, total))
+            if any(size for _target, size in cumulative):
+                self._shift_tree_values(tree_id, cumulative[::-1])
+
+    def _shift_tree_values(self, tree_id, shifts):
+        """
+        Adds ``size`` to the left and right values greater than ``target`` in
+        the tree identified by ``tree_id``, for the ``(target, size)`` pairs in
+        ``shifts``, which must be sorted by descending ``target``. Only the
+        first matching pair applies to each value.
+        """
+        connection = self._get_connection()
+        templates = self._get_sql_templates(connection)
+        if len(shifts) == 1:
+            space_query = templates["space"]
+        else:
+            # statements with more pairs are cached along with the templates.
+            key = ("space", len(shifts))
+            space_query = templates.get(key)
+            if space_query is None:
+                table, left, right, tree_id_column = (
+                    templates["table"],
+                    templates["left"],
+                    templates["right"],
+                    templates["tree_id"],
+                )
+                when = """
+                    WHEN {0} > %s
+                        THEN {0} + %s"""
+                left_when = when.format(left) * len(shifts)
+                right_when = when.format(right) * len(shifts)
+                space_query = f"""
             UPDATE {table}
-            SET {left} = CASE
-                    WHEN {left} > %s
-                        THEN {left} + %s
+            SET {left} = CASE{left_when}
                     ELSE {left} END,
-                {right} = CASE
-                    WHEN {right} > %s
-                        THEN {right} + %s
+                {right} = CASE{right_when}
                     ELSE {right} END
-            WHERE {tree_id} = %s
-              AND ({left} > %s OR {right} > %s)""".format(
-                table=qn(self.tree_model._meta.db_table),
-                left=qn(opts.get_field(self.left_attr).column),
-                right=qn(opts.get_field(self.right_attr).column),
-                tree_id=qn(opts.get_field(self.tree_id_attr).column),
-            )
-            cursor = connection.cursor()
+            WHERE {tree_id_column} = %s
+              AND {right} > %s"""
+                templates[key] = space_query
+        params = list(chain.from_iterable(shifts))
+        with connection.cursor() as cursor:
             cursor.execute(
                 space_query,
                 [
-                    target,
-                    size,
-                    target,
-                    size,
-                    clean_tree_ids(
-                        tree_id,
-                        root_ordering=root_ordering,
-                        vendor=connection.vendor
-                    ),
-                    target,
-                    target,
-                ]
+                    *params,
+                    *params,
+                    self._clean_tree_ids(connection, tree_id),
+                    # right is always greater than left, so this also matches
+                    # every row whose left value is shifted.
+                    shifts[-1][0],
+                ],
             )
 
     def _move_child_node(self, node, target, position):
@@ -1147,9 +1947,7 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         ``node`` will be modified to reflect its new tree state in the
         database.
         """
-        left = getattr(node, self.left_attr)
-        right = getattr(node, self.right_attr)
-        level = getattr(node, self.level_attr)
+        left, right, level, _tree_id = self._node_state(node)
         new_tree_id = getattr(target, self.tree_id_attr)
 
         (
@@ -1160,24 +1958,21 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
             new_parent_right,
         ) = self._calculate_inter_tree_move_values(node, target, position)
 
-        tree_width = right - left + 1
-
-        # Make space for the subtree which will be moved
-        self._create_space(tree_width, space_target, new_tree_id)
-        # Move the subtree
-        self._inter_tree_move_and_close_gap(
-            node, level_change, left_right_change, new_tree_id
+        # Make space for the subtree and move it
+        self._move_to_other_tree(
+            node, level_change, left_right_change, new_tree_id, space_target
         )
 
         # Update the node to be consistent with the updated
         # tree in the database.
-        setattr(node, self.left_attr, left - left_right_change)
-        setattr(node, self.right_attr, right - left_right_change)
-        setattr(node, self.level_attr, level - level_change)
-        setattr(node, self.tree_id_attr, new_tree_id)
-        setattr(node, self.parent_attr, parent)
-
-        node._mptt_cached_fields[self.parent_attr] = parent.pk
+        self._set_node_state(
+            node,
+            left - left_right_change,
+            right - left_right_change,
+            level - level_change,
+            new_tree_id,
+            parent,
+        )
 
     def _move_child_within_tree(self, node, target, position):
         """
@@ -1187,14 +1982,11 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         ``node`` will be modified to reflect its new tree state in the
         database.
         """
-        left = getattr(node, self.left_attr)
-        right = getattr(node, self.right_attr)
-        level = getattr(node, self.level_attr)
+        left, right, level, tree_id = self._node_state(node)
         width = right - left + 1
-        tree_id = getattr(node, self.tree_id_attr)
-        target_left = getattr(target, self.left_attr)
-        target_right = getattr(target, self.right_attr)
-        target_level = getattr(target, self.level_attr)
+        target_left, target_right, target_level, _target_tree_id = self._node_state(
+            target
+        )
 
         if position == "last-child" or position == "first-child":
             if node == target:
@@ -1203,20 +1995,6 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
                 raise InvalidMove(
                     _("A node may not be made a child of any of its descendants.")
                 )
-            if position == "last-child":
-                if target_right > right:
-                    new_left = target_right - width
-                    new_right = target_right - 1
-                else:
-                    new_left = target_right
-                    new_right = target_right + width - 1
-            else:
-                if target_left > left:
-                    new_left = target_left - width + 1
-                    new_right = target_left
-                else:
-                    new_left = target_left + 1
-                    new_right = target_left + width
             level_change = level - target_level - 1
             parent = target
         elif position == "left" or position == "right":
@@ -1226,25 +2004,14 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
                 raise InvalidMove(
                     _("A node may not be made a sibling of any of its descendants.")
                 )
-            if position == "left":
-                if target_left > left:
-                    new_left = target_left - width
-                    new_right = target_left - 1
-                else:
-                    new_left = target_left
-                    new_right = target_left + width - 1
-            else:
-                if target_right > right:
-                    new_left = target_right - width + 1
-                    new_right = target_right
-                else:
-                    new_left = target_right + 1
-                    new_right = target_right + width
             level_change = level - target_level
             parent = getattr(target, self.parent_attr)
         else:
             raise ValueError(_("An invalid position was given: %s.") % position)
 
+        new_left, new_right = _new_span_within_tree(
+            left, right, target_left, target_right, position
+        )
         left_boundary = min(left, new_left)
         right_boundary = max(right, new_right)
         left_right_change = new_left - left
@@ -1252,75 +2019,42 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         if left_right_change > 0:
             gap_size = -gap_size
 
-        connection = self._get_connection(instance=node)
-        qn = connection.ops.quote_name
-
-        opts = self.model._meta
-        root_ordering = self.model._mptt_meta.root_node_ordering
-        # The level update must come before the left update to keep
-        # MySQL happy - left seems to refer to the updated value
-        # immediately after its update has been specified in the query
-        # with MySQL, but not with SQLite or Postgres.
-        move_subtree_query = """
-        UPDATE {table}
-        SET {level} = CASE
-                WHEN {left} >= %s AND {left} <= %s
-                  THEN {level} - %s
-                ELSE {level} END,
-            {left} = CASE
-                WHEN {left} >= %s AND {left} <= %s
-                  THEN {left} + %s
-                WHEN {left} >= %s AND {left} <= %s
-                  THEN {left} + %s
-                ELSE {left} END,
-            {right} = CASE
-                WHEN {right} >= %s AND {right} <= %s
-                  THEN {right} + %s
-                WHEN {right} >= %s AND {right} <= %s
-                  THEN {right} + %s
-                ELSE {right} END
-        WHERE {tree_id} = %s""".format(
-            table=qn(self.tree_model._meta.db_table),
-            level=qn(opts.get_field(self.level_attr).column),
-            left=qn(opts.get_field(self.left_attr).column),
-            right=qn(opts.get_field(self.right_attr).column),
-            tree_id=qn(opts.get_field(self.tree_id_attr).column),
-        )
-
-        cursor = connection.cursor()
-        cursor.execute(
-            move_subtree_query,
-            [
-                left,
-                right,
-                level_change,
-                left,
-                right,
-                left_right_change,
-                left_boundary,
-                right_boundary,
-                gap_size,
-                left,
-                right,
-                left_right_change,
-                left_boundary,
-                right_boundary,
-                gap_size,
-                clean_tree_ids(
-                    tree_id,
-                    root_ordering=root_ordering,
-                    vendor=connection.vendor
-                ),
-            ],
-        )
+        # the node may already be in that position.
+        if left_right_change or level_change:
+            connection = self._get_connection(instance=node)
+            with connection.cursor() as cursor:
+                cursor.execute(
+                    self._get_sql_templates(connection)["move_subtree"],
+                    [
+                        left,
+                        right,
+                        level_change,
+                        left,
+                        right,
+                        left_right_change,
+                        left_boundary,
+                        right_boundary,
+                        gap_size,
+                        left,
+                        right,
+                        left_right_change,
+                        left_boundary,
+                        right_boundary,
+                        gap_size,
+                        self._clean_tree_ids(connection, tree_id),
+                        # only the rows between the boundaries change
+                        left_boundary,
+                        right_boundary,
+                        left_boundary,
+                        right_boundary,
+                    ],
+                )
 
         # Update the node to be consistent with the updated
         # tree in the database.
-        setattr(node, self.left_attr, new_left)
-        setattr(node, self.right_attr, new_right)
-        setattr(node, self.level_attr, level - level_change)
-        setattr(node, self.parent_attr, parent)
-        node._mptt_cached_fields[self.parent_attr] = parent.pk
+        self._set_node_state(
+            node, new_left, new_right, level - level_change, tree_id, parent
+        )
 
     def _move_root_node(self, node, target, position):
         """
@@ -1331,12 +2065,8 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
         ``node`` will be modified to reflect its new tree state in the
         database.
         """
-        left = getattr(node, self.left_attr)
-        right = getattr(node, self.right_attr)
-        level = getattr(node, self.level_attr)
-        tree_id = getattr(node, self.tree_id_attr)
+        left, right, level, tree_id = self._node_state(node)
         new_tree_id = getattr(target, self.tree_id_attr)
-        width = right - left + 1
 
         if node == target:
             raise InvalidMove(_("A node may not be made a child of itself."))
@@ -1353,56 +2083,19 @@ class TreeManager(models.Manager.from_queryset(TreeQuerySet)):
             right_shift,
         ) = self._calculate_inter_tree_move_values(node, target, position)
 
-        # Create space for the tree which will be inserted
-        self._create_space(width, space_target, new_tree_id)
-
-        # Move the root node, making it a child node
-        connection = self._get_connection(instance=node)
-        qn = connection.ops.quote_name
-
-        opts = self.model._meta
-        root_ordering = self.model._mptt_meta.root_node_ordering
-        move_tree_query = """
-        UPDATE {table}
-        SET {level} = {level} - %s,
-            {left} = {left} - %s,
-            {right} = {right} - %s,
-            {tree_id} = %s
-        WHERE {left} >= %s AND {left} <= %s
-          AND {tree_id} = %s""".format(
-            table=qn(self.tree_model._meta.db_table),
-            level=qn(opts.get_field(self.level_attr).column),
-            left=qn(opts.get_field(self.left_attr).column),
-            right=qn(opts.get_field(self.right_attr).column),
-            tree_id=qn(opts.get_field(self.tree_id_attr).column),
-        )
-
-        cleaned_tree_id, cleaned_new_tree_id = clean_tree_ids(
-            tree_id,
-            new_tree_id,
-            root_ordering=root_ordering,
-            vendor=connection.vendor,
-        )
-
-        cursor = connection.cursor()
-        cursor.execute(
-            move_tree_query,
-            [
-                level_change,
-                left_right_change,
-                left_right_change,
-                cleaned_new_tree_id,
-                left,
-                right,
-                cleaned_tree_id,
-            ],
+        # Create space for the tree which will be inserted and move the root
+        # node, making it a child node
+        self._move_to_other_tree(
+            node, level_change, left_right_change, new_tree_id, space_target
         )
 
         # Update the former root node to be consistent with the updated
         # tree in the database.
-        setattr(node, self.left_attr, left - left_right_change)
-        setattr(node, self.right_attr, right - left_right_change)
-        setattr(node, self.level_attr, level - level_change)
-        setattr(node, self.tree_id_attr, new_tree_id)
-        setattr(node, self.parent_attr, parent)
-        node._mptt_cached_fields[self.parent_attr] = parent.pk
+        self._set_node_state(
+            node,
+            left - left_right_change,
+            right - left_right_change,
+            level - level_change,
+            new_tree_id,
+            parent,
+        )
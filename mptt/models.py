@@ -496,6 +496,7 @@ class MPTTModel(models.Model, metaclass=MPTTModelBase):
         ), "Can't start or stop mptt tracking on a non-tracking class."
         assert not cls._mptt_is_tracking, "mptt tracking is already started."
         cls._threadlocal.mptt_delayed_tree_changes = set()
+        cls._threadlocal.mptt_next_tree_id = None
 
     @classmethod
     def _mptt_stop_tracking(cls):
@@ -505,6 +506,7 @@ class MPTTModel(models.Model, metaclass=MPTTModelBase):
         assert cls._mptt_is_tracking, "mptt tracking isn't started."
         results = cls._threadlocal.mptt_delayed_tree_changes
         cls._threadlocal.mptt_delayed_tree_changes = None
+        cls._threadlocal.mptt_next_tree_id = None
         return results
 
     @classmethod
@@ -517,6 +519,9 @@ class MPTTModel(models.Model, metaclass=MPTTModelBase):
     def _mptt_track_tree_insertions(cls, tree_id, num_inserted):
         if not cls._mptt_is_tracking:
             return
+        if num_inserted:
+            # tree ids have shifted, so the memoized next tree id is stale.
+            cls._threadlocal.mptt_next_tree_id = None
         changes = cls._threadlocal.mptt_delayed_tree_changes
         if not num_inserted or not changes:
             return
@@ -561,6 +566,7 @@ class MPTTModel(models.Model, metaclass=MPTTModelBase):
                 right += 1
 
             qs = self._tree_manager._mptt_filter(
+                self._tree_manager._unordered_queryset(),
                 left__lte=left,
                 right__gte=right,
                 tree_id=self._mpttfield("tree_id"),
@@ -749,6 +755,7 @@ class MPTTModel(models.Model, metaclass=MPTTModelBase):
             return self
 
         return self._tree_manager._mptt_filter(
+            self._tree_manager._unordered_queryset(),
             tree_id=self._mpttfield("tree_id"),
             parent=None,
         ).get()
@@ -873,7 +880,7 @@ class MPTTModel(models.Model, metaclass=MPTTModelBase):
             if not hasattr(self, "_mptt_saved"):
                 manager = self.__class__._base_manager
                 manager = manager.using(using)
-                self._mptt_saved = manager.filter(pk=self.pk).exists()
+                self._mptt_saved = manager.filter(pk=self.pk).order_by().exists()
             return self._mptt_saved
 
     def _get_user_field_names(self):
@@ -1078,7 +1085,8 @@ class MPTTModel(models.Model, metaclass=MPTTModelBase):
             # new node, do an insert
             if getattr(self, opts.left_attr) and getattr(self, opts.right_attr):
                 # This node has already been set up for insertion.
-                pass
+                if parent_id is None:
+                    self._tree_manager._tree_id_used(getattr(self, opts.tree_id_attr))
             else:
                 parent = getattr(self, opts.parent_attr)
 
@@ -1147,13 +1155,18 @@ class MPTTModel(models.Model, metaclass=MPTTModelBase):
         tree_width = self._mpttfield("right") - self._mpttfield("left") + 1
         target_right = self._mpttfield("right")
         tree_id = self._mpttfield("tree_id")
-        self._tree_manager._close_gap(tree_width, target_right, tree_id)
+        if self._mpttfield("left") > 1:
+            # a root node takes its whole tree with it, leaving no gap.
+            self._tree_manager._close_gap(tree_width, target_right, tree_id)
         parent = cached_field_value(self, self._mptt_meta.parent_attr)
         if parent:
             right_shift = -self.get_descendant_count() - 2
             self._tree_manager._post_insert_update_cached_parent_right(
                 parent, right_shift
             )
+        else:
+            # the tree id of a deleted root may be handed out again.
+            self._tree_manager._forget_next_tree_id()
 
         return super().delete(*args, **kwargs)
 
@@ -1165,7 +1178,8 @@ class MPTTModel(models.Model, metaclass=MPTTModelBase):
         manager = type(self)._tree_manager
         opts = self._mptt_meta
         values = (
-            manager.using(self._state.db)
+            manager._unordered_queryset()
+            .using(self._state.db)
             .filter(pk=self.pk)
             .values(
                 opts.left_attr,
@@ -15,6 +15,15 @@ class TreeQuerySet(models.query.QuerySet):
     as_manager.queryset_only = True
     as_manager = classmethod(as_manager)
 
+    def delete(self, *args, **kwargs):
+        result = super().delete(*args, **kwargs)
+        # the tree ids of deleted roots may be handed out again.
+        self.model._tree_manager._forget_next_tree_id()
+        return result
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
     def get_descendants(self, *args, **kwargs):
         """
         Alias to `mptt.managers.TreeManager.get_queryset_descendants`.
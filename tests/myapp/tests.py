@@ -3,16 +3,19 @@ import os
 import re
 import sys
 import unittest
+import unittest.mock
 
 import django
 from django.apps import apps
 from django.contrib.admin import ModelAdmin, site
 from django.contrib.admin.views.main import ChangeList
 from django.contrib.auth.models import Group, User
+from django.db import connection
 from django.db.models import Q
 from django.db.models.query_utils import DeferredAttribute
 from django.template import Context, Template, TemplateSyntaxError
 from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from model_bakery import baker
 from model_mommy import mommy
 
@@ -53,7 +56,7 @@ from myapp.models import (
 )
 
 from mptt.exceptions import CantDisableUpdates, InvalidMove
-from mptt.managers import TreeManager
+from mptt.managers import FastUpdateQuerySet, TreeManager
 from mptt.models import MPTTModel
 from mptt.signals import node_moved
 from mptt.templatetags.mptt_tags import cache_tree_children
@@ -336,6 +339,130 @@ class ReparentingTestCase(TreeTestCase):
         rpg.save()
         self.assertEqual(rpg.parent, action)
 
+    @unittest.skipIf(connection.vendor == "mysql", "MySQL creates the space separately")
+    def test_move_subtree_to_other_tree_num_queries(self):
+        shmup = Genre.objects.get(id=6)
+        rpg = Genre.objects.get(id=9)
+        with self.assertNumQueries(2):
+            # 1 query to make space and move the nodes,
+            # 1 query to save the new parent.
+            Genre.objects.move_node(shmup, rpg)
+        self.assertTreeEqual([shmup], "6 9 2 1 6 11")
+        self.assertTreeEqual(
+            Genre.objects.all(),
+            """
+            1 - 1 0 1 10
+            2 1 1 1 2 9
+            3 2 1 2 3 4
+            4 2 1 2 5 6
+            5 2 1 2 7 8
+            9 - 2 0 1 12
+            10 9 2 1 2 3
+            11 9 2 1 4 5
+            6 9 2 1 6 11
+            7 6 2 2 7 8
+            8 6 2 2 9 10
+        """,
+        )
+
+    @unittest.skipIf(connection.vendor == "mysql", "MySQL creates the space separately")
+    def test_bulk_move_to_tree(self):
+        shmup = Genre.objects.get(id=6)
+        platformer_2d = Genre.objects.get(id=3)
+        rpg = Genre.objects.get(id=9)
+        with self.assertNumQueries(2):
+            # 1 query to make space for and move all the nodes,
+            # 1 query to save the new parents.
+            Genre.objects._bulk_move_to_tree([shmup, platformer_2d], rpg)
+        self.assertTreeEqual([shmup, platformer_2d], "6 9 2 1 6 11\n3 9 2 1 12 13")
+        self.assertTreeEqual([rpg], "9 - 2 0 1 14")
+        self.assertTreeEqual(
+            Genre.objects.all(),
+            """
+            1 - 1 0 1 8
+            2 1 1 1 2 7
+            4 2 1 2 3 4
+            5 2 1 2 5 6
+            9 - 2 0 1 14
+            10 9 2 1 2 3
+            11 9 2 1 4 5
+            6 9 2 1 6 11
+            7 6 2 2 7 8
+            8 6 2 2 9 10
+            3 9 2 1 12 13
+        """,
+        )
+
+    def test_bulk_move_to_tree_first_child(self):
+        shmup = Genre.objects.get(id=6)
+        platformer_2d = Genre.objects.get(id=3)
+        rpg = Genre.objects.get(id=9)
+        Genre.objects._bulk_move_to_tree([shmup, platformer_2d], rpg, "first-child")
+        self.assertTreeEqual([shmup, platformer_2d], "6 9 2 1 4 9\n3 9 2 1 2 3")
+        self.assertTreeEqual([rpg], "9 - 2 0 1 14")
+        self.assertTreeEqual(
+            Genre.objects.all(),
+            """
+            1 - 1 0 1 8
+            2 1 1 1 2 7
+            4 2 1 2 3 4
+            5 2 1 2 5 6
+            9 - 2 0 1 14
+            3 9 2 1 2 3
+            6 9 2 1 4 9
+            7 6 2 2 5 6
+            8 6 2 2 7 8
+            10 9 2 1 10 11
+            11 9 2 1 12 13
+        """,
+        )
+
+    @unittest.skipIf(
+        connection.vendor == "mysql", "MySQL creates the tree space separately"
+    )
+    def test_move_child_to_root_sibling_num_queries(self):
+        shmup = Genre.objects.get(id=6)
+        action = Genre.objects.get(id=1)
+        with self.assertNumQueries(2):
+            # 1 query to make room for the new tree and move the nodes,
+            # 1 query to save the new parent.
+            Genre.objects.move_node(shmup, action, "right")
+        self.assertTreeEqual([shmup], "6 - 2 0 1 6")
+        self.assertTreeEqual(
+            Genre.objects.all(),
+            """
+            1 - 1 0 1 10
+            2 1 1 1 2 9
+            3 2 1 2 3 4
+            4 2 1 2 5 6
+            5 2 1 2 7 8
+            6 - 2 0 1 6
+            7 6 2 1 2 3
+            8 6 2 1 4 5
+            9 - 3 0 1 6
+            10 9 3 1 2 3
+            11 9 3 1 4 5
+        """,
+        )
+
+    def test_move_root_to_adjacent_root_sibling_num_queries(self):
+        action = Genre.objects.get(id=1)
+        rpg = Genre.objects.get(id=9)
+        with self.assertNumQueries(1):
+            # Only the save, as the roots are in order already.
+            Genre.objects.move_node(action, rpg, "left")
+        with self.assertNumQueries(1):
+            Genre.objects.move_node(rpg, action, "right")
+        self.assertTreeEqual([action, rpg], "1 - 1 0 1 16\n9 - 2 0 1 6")
+
+    def test_move_child_to_own_position_num_queries(self):
+        platformer_3d = Genre.objects.get(id=5)
+        platformer = Genre.objects.get(id=2)
+        with self.assertNumQueries(1):
+            # Only the save, as the node already is the last child.
+            Genre.objects.move_node(platformer_3d, platformer, "last-child")
+        self.assertTreeEqual([platformer_3d], "5 2 1 2 7 8")
+
     def test_invalid_moves(self):
         # A node may not be made a child of itself
         action = Genre.objects.get(id=1)
@@ -515,6 +642,17 @@ class DeletionTestCase(TreeTestCase):
         """,
         )
 
+    def test_delete_root_node_without_gap_update(self):
+        root = Category.objects.get(id=1)
+        with CaptureQueriesContext(connection) as queries:
+            root.delete()
+        # the whole tree goes with its root, so there is no gap to close
+        self.assertFalse([q for q in queries if q["sql"].startswith("UPDATE")], queries)
+        self.assertFalse(Category.objects.exists())
+
+        with self.assertNumQueries(0):
+            Category.objects._create_space(0, 1, 1)
+
     def test_delete_last_node_with_siblings(self):
         Category.objects.get(id=9).delete()
         self.assertTreeEqual(
@@ -912,8 +1050,29 @@ class DelayedUpdatesTestCase(TreeTestCase):
             self.assertTrue(ConcreteModel._mptt_is_tracking)
         self.assertFalse(ConcreteModel._mptt_is_tracking)
 
+    def test_insert_roots(self):
+        with ConcreteModel.objects.delay_mptt_updates(), self.assertNumQueries(4):
+            # 1 query for the next tree id,
+            # 1 query to save each node.
+            ConcreteModel.objects.create(name="e")
+            ConcreteModel.objects.create(name="f")
+            ConcreteModel.objects.create(name="g")
+        self.assertTreeEqual(
+            ConcreteModel.objects.all(),
+            """
+            1 - 1 0 1 6
+            2 1 1 1 2 3
+            3 1 1 1 4 5
+            4 - 2 0 1 2
+            5 - 3 0 1 2
+            6 - 4 0 1 2
+            7 - 5 0 1 2
+            8 - 6 0 1 2
+        """,
+        )
+
     def test_insert_child(self):
-        with self.assertNumQueries(7), ConcreteModel.objects.delay_mptt_updates():
+        with self.assertNumQueries(6), ConcreteModel.objects.delay_mptt_updates():
             with self.assertNumQueries(2):
                 # 1 query for target stale check,
                 # 1 query to save node.
@@ -930,7 +1089,7 @@ class DelayedUpdatesTestCase(TreeTestCase):
                     5 - 3 0 1 2
                 """,
             )
-            # remaining queries (4 through 7) are the partial rebuild process.
+            # remaining queries (4 through 6) are the partial rebuild process.
 
         self.assertTreeEqual(
             ConcreteModel.objects.all(),
@@ -977,7 +1136,7 @@ class DelayedUpdatesTestCase(TreeTestCase):
         )
 
     def test_move_node_same_tree(self):
-        with self.assertNumQueries(7), ConcreteModel.objects.delay_mptt_updates():
+        with self.assertNumQueries(6), ConcreteModel.objects.delay_mptt_updates():
             with self.assertNumQueries(2):
                 # 1 query to ensure target fields aren't stale
                 # 1 update query
@@ -994,7 +1153,7 @@ class DelayedUpdatesTestCase(TreeTestCase):
                     5 - 3 0 1 2
                 """,
             )
-            # the remaining 4 queries are the partial rebuild.
+            # the remaining 3 queries are the partial rebuild.
 
         self.assertTreeEqual(
             ConcreteModel.objects.all(),
@@ -1008,7 +1167,7 @@ class DelayedUpdatesTestCase(TreeTestCase):
         )
 
     def test_move_node_different_tree(self):
-        with self.assertNumQueries(7), ConcreteModel.objects.delay_mptt_updates():
+        with self.assertNumQueries(6), ConcreteModel.objects.delay_mptt_updates():
             with self.assertNumQueries(2):
                 # 2 queries here:
                 #  1. update the node
@@ -1026,7 +1185,7 @@ class DelayedUpdatesTestCase(TreeTestCase):
                     5 - 2 0 1 2
                 """,
             )
-            # the other 4 queries are the partial rebuild
+            # the other 3 queries are the partial rebuild
 
         self.assertTreeEqual(
             ConcreteModel.objects.all(),
@@ -1072,7 +1231,7 @@ class DelayedUpdatesTestCase(TreeTestCase):
         )
 
     def test_move_root_to_child(self):
-        with self.assertNumQueries(7), ConcreteModel.objects.delay_mptt_updates():
+        with self.assertNumQueries(6), ConcreteModel.objects.delay_mptt_updates():
             with self.assertNumQueries(2):
                 # 2 queries here:
                 #  1. update the node
@@ -1090,7 +1249,7 @@ class DelayedUpdatesTestCase(TreeTestCase):
                     5 - 2 0 1 2
                 """,
             )
-            # the remaining 4 queries are the partial rebuild.
+            # the remaining 3 queries are the partial rebuild.
 
         self.assertTreeEqual(
             ConcreteModel.objects.all(),
@@ -1158,7 +1317,7 @@ class OrderedInsertionDelayedUpdatesTestCase(TreeTestCase):
         )
 
     def test_insert_child(self):
-        with self.assertNumQueries(7), OrderedInsertion.objects.delay_mptt_updates():
+        with self.assertNumQueries(6), OrderedInsertion.objects.delay_mptt_updates():
             with self.assertNumQueries(2):
                 # 1 query here:
                 OrderedInsertion.objects.create(name="dd", parent=self.c)
@@ -1174,7 +1333,7 @@ class OrderedInsertionDelayedUpdatesTestCase(TreeTestCase):
                     5 - 3 0 1 2
                 """,
             )
-            # remaining 4 queries are the partial rebuild process.
+            # remaining 3 queries are the partial rebuild process.
 
         self.assertTreeEqual(
             OrderedInsertion.objects.all(),
@@ -1223,7 +1382,7 @@ class OrderedInsertionDelayedUpdatesTestCase(TreeTestCase):
         )
 
     def test_move_node_same_tree(self):
-        with self.assertNumQueries(6), OrderedInsertion.objects.delay_mptt_updates():
+        with self.assertNumQueries(5), OrderedInsertion.objects.delay_mptt_updates():
             with self.assertNumQueries(1):
                 # 1 update query
                 self.e.name = "before d"
@@ -1239,7 +1398,7 @@ class OrderedInsertionDelayedUpdatesTestCase(TreeTestCase):
                     5 - 3 0 1 2
                 """,
             )
-            # the remaining 4 queries are the partial rebuild.
+            # the remaining 3 queries are the partial rebuild.
 
         self.assertTreeEqual(
             OrderedInsertion.objects.all(),
@@ -1253,7 +1412,7 @@ class OrderedInsertionDelayedUpdatesTestCase(TreeTestCase):
         )
 
     def test_move_node_different_tree(self):
-        with self.assertNumQueries(7), OrderedInsertion.objects.delay_mptt_updates():
+        with self.assertNumQueries(6), OrderedInsertion.objects.delay_mptt_updates():
             with self.assertNumQueries(2):
                 # 2 queries here:
                 #  1. update the node
@@ -1272,7 +1431,7 @@ class OrderedInsertionDelayedUpdatesTestCase(TreeTestCase):
                     5 - 2 0 1 2
                 """,
             )
-            # the remaining 4 queries are the partial rebuild
+            # the remaining 3 queries are the partial rebuild
 
         self.assertTreeEqual(
             OrderedInsertion.objects.all(),
@@ -1318,7 +1477,7 @@ class OrderedInsertionDelayedUpdatesTestCase(TreeTestCase):
         )
 
     def test_move_root_to_child(self):
-        with self.assertNumQueries(7), OrderedInsertion.objects.delay_mptt_updates():
+        with self.assertNumQueries(6), OrderedInsertion.objects.delay_mptt_updates():
             with self.assertNumQueries(2):
                 # 2 queries here:
                 #  1. update the node
@@ -1336,7 +1495,7 @@ class OrderedInsertionDelayedUpdatesTestCase(TreeTestCase):
                     5 - 2 0 1 2
                 """,
             )
-            # the remaining 4 queries are the partial rebuild.
+            # the remaining 3 queries are the partial rebuild.
 
         self.assertTreeEqual(
             OrderedInsertion.objects.all(),
@@ -1535,6 +1694,42 @@ class ManagerTests(TreeTestCase):
             )
             self.assertEqual(len(qs), 10)
 
+    def test_get_queryset_relatives_of_evaluated_queryset_after_move(self):
+        """
+        Test that the values of an already evaluated queryset are not reused.
+        """
+        qs = Genre.objects.filter(name="Platformer")
+        list(qs)
+        Genre.objects.move_node(
+            Genre.objects.get(name="Platformer"),
+            Genre.objects.get(name="Role-playing Game"),
+        )
+        desc = Genre.objects.get_queryset_descendants(qs)
+        self.assertEqual(
+            sorted(desc.values_list("name", flat=True)),
+            ["2D Platformer", "3D Platformer", "4D Platformer"],
+        )
+
+    def test_get_queryset_relatives_above_fastpath_threshold(self):
+        qs = Genre.objects.filter(Q(name="Platformer") | Q(name="Shootemup"))
+        # the first node is read up front and the second one is streamed.
+        with unittest.mock.patch.object(TreeManager, "_range_fastpath_threshold", 0):
+            self.assertEqual(
+                self._get_anc_names(qs, include_self=True),
+                ["Action", "Platformer", "Shootemup"],
+            )
+            desc = Genre.objects.get_queryset_descendants(qs)
+            self.assertEqual(
+                sorted(desc.values_list("name", flat=True)),
+                [
+                    "2D Platformer",
+                    "3D Platformer",
+                    "4D Platformer",
+                    "Horizontal Scrolling Shootemup",
+                    "Vertical Scrolling Shootemup",
+                ],
+            )
+
     def test_default_manager_with_multiple_managers(self):
         """
         Test that a model with multiple managers defined always uses the
@@ -3207,3 +3402,218 @@ class CustomParentAttrModelTestCase(TreeTestCase):
             1 - 1 0 1 2
             """
         )
+
+
+class BufferedSpaceTestCase(TreeTestCase):
+    def setUp(self):
+        self.a = ConcreteModel.objects.create(name="a")
+        self.b = ConcreteModel.objects.create(name="b", parent=self.a)
+        self.c = ConcreteModel.objects.create(name="c", parent=self.a)
+        self.d = ConcreteModel.objects.create(name="d")
+
+    def test_insert_nodes(self):
+        nodes = [ConcreteModel(name=name) for name in "efg"]
+        with self.assertNumQueries(1), ConcreteModel.objects.buffered_space():
+            for node in nodes:
+                ConcreteModel.objects.insert_node(
+                    node, self.a, save=False, refresh_target=False
+                )
+        ConcreteModel.objects.bulk_create(nodes)
+        self.assertTreeEqual(
+            ConcreteModel.objects.all(),
+            """
+            1 - 1 0 1 12
+            2 1 1 1 2 3
+            3 1 1 1 4 5
+            5 1 1 1 6 7
+            6 1 1 1 8 9
+            7 1 1 1 10 11
+            4 - 2 0 1 2
+        """,
+        )
+
+    def test_insert_nodes_before_inserted_nodes(self):
+        e, f, g = (ConcreteModel(name=name) for name in "efg")
+        with self.assertNumQueries(1), ConcreteModel.objects.buffered_space():
+            for node, target, position in [
+                (e, self.a, "first-child"),
+                (f, self.a, "first-child"),
+                (g, e, "left"),
+            ]:
+                ConcreteModel.objects.insert_node(
+                    node, target, position, save=False, refresh_target=False
+                )
+        ConcreteModel.objects.bulk_create([e, f, g])
+        self.assertTreeEqual(
+            ConcreteModel.objects.all(),
+            """
+            1 - 1 0 1 12
+            6 1 1 1 2 3
+            7 1 1 1 4 5
+            5 1 1 1 6 7
+            2 1 1 1 8 9
+            3 1 1 1 10 11
+            4 - 2 0 1 2
+        """,
+        )
+
+    def test_matches_sequential_spaces(self):
+        # targets are relative to the tree as left by the previous spaces,
+        # just like consecutive calls to _create_space outside the block.
+        with self.assertNumQueries(2), ConcreteModel.objects.buffered_space():
+            ConcreteModel.objects._create_space(2, 3, 1)
+            ConcreteModel.objects._create_space(4, 1, 1)
+            ConcreteModel.objects._create_space(2, 8, 1)
+            ConcreteModel.objects._create_space(2, 5, 1)
+            ConcreteModel.objects._create_space(6, 1, 2)
+        self.assertTreeEqual(
+            ConcreteModel.objects.all(),
+            """
+            1 - 1 0 1 16
+            2 1 1 1 8 9
+            3 1 1 1 14 15
+            4 - 2 0 1 8
+        """,
+        )
+
+    def test_closes_gaps(self):
+        ConcreteModel.objects.filter(pk=self.b.pk).delete()
+        with self.assertNumQueries(1), ConcreteModel.objects.buffered_space():
+            ConcreteModel.objects._create_space(4, 1, 1)
+            ConcreteModel.objects._close_gap(2, 7, 1)
+            # these cancel out, so tree 2 isn't updated at all.
+            ConcreteModel.objects._create_space(2, 1, 2)
+            ConcreteModel.objects._close_gap(2, 3, 2)
+        self.assertTreeEqual(
+            ConcreteModel.objects.all(),
+            """
+            1 - 1 0 1 8
+            3 1 1 1 6 7
+            4 - 2 0 1 2
+        """,
+        )
+
+    def test_insert_root_sibling_raises(self):
+        with ConcreteModel.objects.buffered_space():
+            ConcreteModel.objects.insert_node(
+                ConcreteModel(name="e"), self.a, save=False, refresh_target=False
+            )
+            self.assertRaises(
+                InvalidMove,
+                ConcreteModel.objects.insert_node,
+                ConcreteModel(name="f"),
+                self.a,
+                "left",
+                refresh_target=False,
+            )
+        self.assertTreeEqual(
+            ConcreteModel.objects.all(),
+            """
+            1 - 1 0 1 8
+            2 1 1 1 2 3
+            3 1 1 1 4 5
+            4 - 2 0 1 2
+        """,
+        )
+
+    def test_discarded_on_interrupt(self):
+        manager = ConcreteModel.objects
+        with self.assertRaises(KeyboardInterrupt), manager.buffered_space():
+            manager._create_space(2, 1, 2)
+            raise KeyboardInterrupt
+        self.assertIsNone(ConcreteModel._threadlocal.mptt_space_buffer)
+        with self.assertNumQueries(1):
+            manager._create_space(2, 1, 2)
+
+    def test_move_node_raises(self):
+        with ConcreteModel.objects.buffered_space():
+            self.assertRaises(
+                InvalidMove, ConcreteModel.objects.move_node, self.d, self.a
+            )
+            self.b.parent = self.d
+            self.assertRaises(InvalidMove, self.b.save)
+        self.assertTreeEqual(
+            ConcreteModel.objects.all(),
+            """
+            1 - 1 0 1 6
+            2 1 1 1 2 3
+            3 1 1 1 4 5
+            4 - 2 0 1 2
+        """,
+        )
+
+
+class NextTreeIdTestCase(TreeTestCase):
+    def test_not_reused_after_preassigned_tree_id(self):
+        with ConcreteModel.objects.delay_mptt_updates():
+            ConcreteModel.objects.create(name="a")
+            ConcreteModel(name="b", tree_id=2, lft=1, rght=2, level=0).save()
+            c = ConcreteModel.objects.create(name="c")
+        self.assertEqual(c.tree_id, 3)
+
+    def test_reused_after_delete(self):
+        with ConcreteModel.objects.delay_mptt_updates():
+            ConcreteModel.objects.create(name="a")
+            ConcreteModel.objects.create(name="b").delete()
+            c = ConcreteModel.objects.create(name="c")
+            ConcreteModel.objects.filter(pk=c.pk).delete()
+            d = ConcreteModel.objects.create(name="d")
+        self.assertEqual((c.tree_id, d.tree_id), (2, 2))
+
+
+class RebuildTestCase(TreeTestCase):
+    def test_rebuild_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        with Genre.objects.disable_mptt_updates():
+            parent_id = None
+            for i in range(depth):
+                parent_id = Genre.objects.create(name=str(i), parent_id=parent_id).pk
+        Genre.objects.rebuild()
+
+        root = Genre.objects.get(name="0")
+        self.assertEqual((root.lft, root.rght, root.level), (1, 2 * depth, 0))
+        leaf = Genre.objects.get(name=str(depth - 1))
+        self.assertEqual(
+            (leaf.lft, leaf.rght, leaf.level), (depth, depth + 1, depth - 1)
+        )
+
+    @unittest.skipIf(FastUpdateQuerySet, "django-fast-update is installed")
+    def test_rebuild_invalid_batch_size(self):
+        Genre.objects.create(name="a")
+        with self.assertRaises(ValueError):
+            Genre.objects.rebuild(batch_size=0)
+
+    @unittest.skipIf(FastUpdateQuerySet is None, "django-fast-update is not installed")
+    def test_rebuild_with_fast_update(self):
+        a = Genre.objects.create(name="a")
+        b = Genre.objects.create(name="b", parent=a)
+        Genre.objects.create(name="c", parent=b)
+        Genre.objects.create(name="d")
+        Genre.objects.update(lft=0, rght=0, level=0, tree_id=0)
+
+        method = "copy_update" if connection.vendor == "postgresql" else "fast_update"
+        with unittest.mock.patch.object(
+            FastUpdateQuerySet,
+            method,
+            autospec=True,
+            side_effect=getattr(FastUpdateQuerySet, method),
+        ) as update:
+            Genre.objects.rebuild()
+
+        update.assert_called_once()
+        objs, fields = update.call_args.args[1:3]
+        self.assertEqual(set(fields), {"lft", "rght", "level", "tree_id"})
+        # the instances are built without loading the other fields.
+        self.assertEqual(
+            {obj.pk for obj in objs}, set(Genre.objects.values_list("pk", flat=True))
+        )
+        self.assertTrue(all("name" in obj.get_deferred_fields() for obj in objs))
+        self.assertTreeEqual(
+            Genre.objects.all(),
+            """
+            1 - 1 0 1 6
+            2 1 1 1 2 5
+            3 2 1 2 3 4
+            4 - 2 0 1 2
+        """,
+        )